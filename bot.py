@@ -12,6 +12,12 @@ import sqlite3
 import datetime
 import pandas as pd
 import os
+import re
+import gzip
+import glob
+import shutil
+import time
+import asyncio
 from flask import Flask
 import threading
 
@@ -23,8 +29,10 @@ import threading
     ENTER_BARCODE,
     ENTER_PRODUCT_DETAILS,
     ENTER_DAMAGE_DETAILS,
-    ENTER_PRODUCT_NAME
-) = range(7)
+    ENTER_PRODUCT_NAME,
+    STOCK_TAKE,
+    ENTER_EXPORT_RANGE
+) = range(9)
 
 # إعداد Flask لربط المنفذ (مطلوب لـ Render)
 app = Flask(__name__)
@@ -46,6 +54,50 @@ logger = logging.getLogger(__name__)
 # لوحة مفاتيح الرجوع
 BACK_KEYBOARD = ReplyKeyboardMarkup([["🔙 رجوع", "🏠 القائمة الرئيسية"]], resize_keyboard=True)
 
+# لوحة مفاتيح وضع الجرد
+STOCK_TAKE_KEYBOARD = ReplyKeyboardMarkup([["✅ إنهاء الجرد"], ["🔙 رجوع", "🏠 القائمة الرئيسية"]], resize_keyboard=True)
+
+# سطر الجرد: باركود مع كمية اختيارية (123456 أو 123456x3)
+STOCK_TAKE_LINE = re.compile(r"^(\d+)\s*(?:[xX×*]\s*(\d+))?$")
+
+# الحد الأقصى لعدد المتغيرات في استعلام IN واحد (حد SQLite الافتراضي 999)
+SQL_IN_CHUNK = 500
+
+# الحد الأقصى لطول رسالة تيليجرام
+MESSAGE_LIMIT = 4000
+
+# إعدادات النسخ الاحتياطي
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = int(os.environ.get('BACKUP_INTERVAL', 6 * 60 * 60))  # بالثواني
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 7))
+PRE_RESTORE_KEEP = 2  # عدد نسخ الأمان المأخوذة قبل الاستعادة
+BACKUP_PAGES = 256  # عدد الصفحات المنسوخة في كل خطوة
+BACKUP_SLEEP = 0.01  # مهلة بين الخطوات لإفساح المجال للمعالجات
+
+# إعدادات أرشفة التالف: الأقدم من فترة الاحتفاظ ينقل إلى جداول أرشيف شهرية
+DAMAGED_RETENTION_DAYS = int(os.environ.get('DAMAGED_RETENTION_DAYS', 90))
+ARCHIVE_INTERVAL = int(os.environ.get('ARCHIVE_INTERVAL', 24 * 60 * 60))  # بالثواني
+ARCHIVE_PREFIX = 'damaged_products_archive_'
+DAMAGED_COLUMNS = "id, barcode, name, quantity, damage_reason, report_date, user_id"
+
+# الأعمدة التي يُعد تعديلها تغييراً يظهر في تصدير التغييرات
+TRACKED_COLUMNS = {
+    'products': "barcode, name, expiry_date, quantity, added_date, user_id",
+    'damaged_products': "barcode, name, quantity, damage_reason, report_date, user_id"
+}
+
+# قفل يمنع تشغيل أكثر من نسخ احتياطي في نفس الوقت
+BACKUP_LOCK = threading.Lock()
+
+# معرفات المستخدمين المسموح لهم بأوامر الإدارة (مفصولة بفواصل)
+ADMIN_IDS = {int(x) for x in os.environ.get('ADMIN_IDS', '').split(',') if x.strip().isdigit()}
+
+def add_column_if_missing(c, table: str, column: str, definition: str):
+    """إضافة عمود لجدول موجود إذا لم يكن موجوداً (ترقية قواعد البيانات القديمة)"""
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
 def init_db():
     """تهيئة قاعدة البيانات"""
     conn = None
@@ -53,6 +105,9 @@ def init_db():
         conn = sqlite3.connect('inventory.db')
         c = conn.cursor()
         
+        # وضع WAL يسمح بالنسخ الاحتياطي أثناء الكتابة دون حجب المعالجات
+        c.execute("PRAGMA journal_mode=WAL")
+        
         c.execute('''CREATE TABLE IF NOT EXISTS products
                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
                       barcode TEXT UNIQUE,
@@ -71,6 +126,38 @@ def init_db():
                       report_date TEXT,
                       user_id INTEGER)''')
         
+        c.execute("CREATE INDEX IF NOT EXISTS idx_damaged_report_date ON damaged_products(report_date)")
+        
+        # تتبع التغييرات: رقم تسلسلي متزايد لكل إضافة أو تعديل
+        c.execute('''CREATE TABLE IF NOT EXISTS change_sequence
+                     (id INTEGER PRIMARY KEY CHECK (id = 1),
+                      value INTEGER NOT NULL)''')
+        c.execute("INSERT OR IGNORE INTO change_sequence (id, value) VALUES (1, 0)")
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS export_watermarks
+                     (user_id INTEGER PRIMARY KEY,
+                      last_seq INTEGER NOT NULL,
+                      exported_at TEXT)''')
+        
+        for table, columns in TRACKED_COLUMNS.items():
+            add_column_if_missing(c, table, 'change_seq', 'INTEGER')
+            add_column_if_missing(c, table, 'updated_at', 'TEXT')
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_change_seq ON {table}(change_seq)")
+            
+            for event in ['INSERT', f'UPDATE OF {columns}']:
+                trigger = f"{table}_{event.split()[0].lower()}_change_seq"
+                # إعادة الإنشاء في كل تشغيل حتى تصل تعديلات الـ trigger لقواعد البيانات الموجودة
+                c.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+                c.execute(f'''CREATE TRIGGER {trigger}
+                             AFTER {event} ON {table}
+                             BEGIN
+                                 UPDATE change_sequence SET value = value + 1 WHERE id = 1;
+                                 UPDATE {table}
+                                 SET change_seq = (SELECT value FROM change_sequence WHERE id = 1),
+                                     updated_at = datetime('now', 'localtime')
+                                 WHERE id = NEW.id;
+                             END''')
+        
         conn.commit()
     except Exception as e:
         logger.error(f"خطأ في تهيئة قاعدة البيانات: {e}")
@@ -86,7 +173,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         ["➕ إضافة صنف جديد", "🗑️ إضافة صنف تالف"],
         ["📋 عرض الأصناف", "📦 عرض التالف"],
-        ["📤 تصدير البيانات"]
+        ["📊 جرد المخزون", "📤 تصدير البيانات"],
+        ["📅 تصدير حسب الفترة", "🔄 تصدير التغييرات"]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
@@ -127,9 +215,32 @@ async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif text == "📦 عرض التالف":
         return await view_damaged_products(update, context)
         
+    elif text == "📊 جرد المخزون":
+        context.user_data.clear()
+        context.user_data['stock_take'] = {}
+        await update.message.reply_text(
+            "📊 وضع الجرد\n\n"
+            "أرسل الباركودات سطراً لكل صنف، ويمكن إرسال عدة أسطر في رسالة واحدة.\n"
+            "لتحديد الكمية استخدم: باركود x كمية (مثال: 123456x3)\n"
+            "تكرار الباركود بدون كمية يُحسب قطعة لكل مسح.\n\n"
+            "عند الانتهاء اضغط \"✅ إنهاء الجرد\"",
+            reply_markup=STOCK_TAKE_KEYBOARD
+        )
+        return STOCK_TAKE
+        
     elif text == "📤 تصدير البيانات":
         return await export_data(update, context)
         
+    elif text == "📅 تصدير حسب الفترة":
+        await update.message.reply_text(
+            "📅 الرجاء إدخال الفترة (من - إلى) بالتنسيق:\nYYYY-MM-DD YYYY-MM-DD",
+            reply_markup=BACK_KEYBOARD
+        )
+        return ENTER_EXPORT_RANGE
+        
+    elif text == "🔄 تصدير التغييرات":
+        return await export_data(update, context, changes_only=True)
+        
     elif text == "🔙 رجوع":
         return await start(update, context)
 
@@ -605,8 +716,108 @@ async def view_damaged_products(update: Update, context: ContextTypes.DEFAULT_TY
     await start(update, context)
     return MAIN_MENU
 
-async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """تصدير البيانات إلى ملف Excel"""
+def archive_table_name(month: str):
+    """اسم جدول الأرشيف لشهر معين (YYYY-MM)"""
+    return ARCHIVE_PREFIX + month.replace('-', '_')
+
+def archive_tables(c):
+    """قائمة جداول أرشيف التالف الموجودة مرتبة حسب الشهر"""
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE ? ORDER BY name",
+              (ARCHIVE_PREFIX + '%',))
+    return [row[0] for row in c.fetchall()]
+
+def archive_damaged_products():
+    """نقل سجلات التالف الأقدم من فترة الاحتفاظ إلى جداول أرشيف شهرية"""
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=DAMAGED_RETENTION_DAYS)).strftime("%Y-%m-%d")
+    conn = None
+    try:
+        conn = sqlite3.connect('inventory.db')
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT substr(report_date, 1, 7) FROM damaged_products WHERE report_date < ?", (cutoff,))
+        months = [row[0] for row in c.fetchall() if row[0] and re.fullmatch(r"\d{4}-\d{2}", row[0])]
+        
+        moved = 0
+        for month in months:
+            table = archive_table_name(month)
+            c.execute(f'''CREATE TABLE IF NOT EXISTS {table}
+                         (id INTEGER PRIMARY KEY,
+                          barcode TEXT,
+                          name TEXT,
+                          quantity INTEGER,
+                          damage_reason TEXT,
+                          report_date TEXT,
+                          user_id INTEGER)''')
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_report_date ON {table}(report_date)")
+            c.execute(f'''INSERT INTO {table} ({DAMAGED_COLUMNS})
+                         SELECT {DAMAGED_COLUMNS} FROM damaged_products
+                         WHERE report_date < ? AND substr(report_date, 1, 7) = ?''', (cutoff, month))
+            moved += c.rowcount
+            c.execute("DELETE FROM damaged_products WHERE report_date < ? AND substr(report_date, 1, 7) = ?",
+                      (cutoff, month))
+        
+        conn.commit()
+        if moved:
+            logger.info(f"✅ تمت أرشفة {moved} سجل تالف أقدم من {cutoff}")
+        return moved
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+def run_archive_scheduler():
+    """تشغيل أرشفة التالف الدورية في thread منفصل"""
+    while True:
+        try:
+            archive_damaged_products()
+        except Exception as e:
+            logger.error(f"خطأ في أرشفة التالف: {e}")
+        time.sleep(ARCHIVE_INTERVAL)
+
+def read_damaged_range(conn, start_date: str, end_date: str):
+    """قراءة سجلات التالف لفترة معينة من الجدول الحالي وجداول الأرشيف المعنية"""
+    c = conn.cursor()
+    first_table = archive_table_name(start_date[:7])
+    last_table = archive_table_name(end_date[:7])
+    tables = ['damaged_products'] + [t for t in archive_tables(c) if first_table <= t <= last_table]
+    
+    # جداول الأرشيف لا تتتبع التغييرات، فتُملأ أعمدة التتبع بـ NULL لتطابق أعمدة التصدير الكامل
+    query = " UNION ALL ".join(
+        f"SELECT {DAMAGED_COLUMNS}, "
+        + ("change_seq, updated_at" if table == 'damaged_products' else "NULL AS change_seq, NULL AS updated_at")
+        + f" FROM {table} WHERE report_date BETWEEN ? AND ?"
+        for table in tables
+    )
+    params = [start_date, end_date] * len(tables)
+    return pd.read_sql_query(f"{query} ORDER BY report_date DESC", conn, params=params)
+
+async def handle_export_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """معالجة إدخال فترة التصدير"""
+    text = update.message.text.strip()
+    
+    if text in ["🔙 رجوع", "🏠 القائمة الرئيسية"]:
+        return await start(update, context)
+    
+    try:
+        start_date, end_date = text.split()
+        datetime.datetime.strptime(start_date, "%Y-%m-%d")
+        datetime.datetime.strptime(end_date, "%Y-%m-%d")
+        if start_date > end_date:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text(
+            "❌ تنسيق الفترة غير صحيح! استخدم: YYYY-MM-DD YYYY-MM-DD",
+            reply_markup=BACK_KEYBOARD
+        )
+        return ENTER_EXPORT_RANGE
+    
+    return await export_data(update, context, start_date, end_date)
+
+async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE, start_date: str = None, end_date: str = None,
+                      changes_only: bool = False):
+    """تصدير البيانات إلى ملف Excel (مع الأرشيف عند تحديد فترة، أو التغييرات فقط منذ آخر تصدير)"""
     try:
         import openpyxl
     except ImportError:
@@ -617,17 +828,56 @@ async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     conn = None
     try:
         conn = sqlite3.connect('inventory.db')
-        products_df = pd.read_sql_query("SELECT * FROM products", conn)
-        damaged_df = pd.read_sql_query("SELECT * FROM damaged_products", conn)
+        c = conn.cursor()
+        user_id = update.message.from_user.id
+        
+        # قراءة الرقم التسلسلي والبيانات من نفس اللقطة حتى لا تضيع تغييرات متزامنة
+        c.execute("BEGIN")
+        c.execute("SELECT value FROM change_sequence WHERE id = 1")
+        current_seq = c.fetchone()[0]
+        c.execute("SELECT last_seq FROM export_watermarks WHERE user_id = ?", (user_id,))
+        watermark = c.fetchone()
+        # أول تصدير تغييرات للمستخدم يكون تصديراً كاملاً
+        last_seq = watermark[0] if changes_only and watermark else None
+        
+        if last_seq is not None:
+            products_df = pd.read_sql_query(
+                "SELECT * FROM products WHERE change_seq > ? ORDER BY change_seq", conn, params=(last_seq,))
+            damaged_df = pd.read_sql_query(
+                f"SELECT {DAMAGED_COLUMNS}, change_seq, updated_at FROM damaged_products "
+                "WHERE change_seq > ? ORDER BY change_seq", conn, params=(last_seq,))
+        else:
+            products_df = pd.read_sql_query("SELECT * FROM products", conn)
+            if start_date:
+                damaged_df = read_damaged_range(conn, start_date, end_date)
+            else:
+                damaged_df = pd.read_sql_query(
+                    f"SELECT {DAMAGED_COLUMNS}, change_seq, updated_at FROM damaged_products", conn)
+        conn.rollback()
         
         if products_df.empty and damaged_df.empty:
             await update.message.reply_text(
-                "📭 لا توجد بيانات لتصديرها",
+                "📭 لا توجد تغييرات منذ آخر تصدير" if last_seq is not None else "📭 لا توجد بيانات لتصديرها",
                 reply_markup=ReplyKeyboardMarkup([["🏠 القائمة الرئيسية"]], resize_keyboard=True)
             )
             return
         
         filename = f"inventory_export_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
+        caption = "📤 تم تصدير بيانات المخزون بنجاح"
+        if start_date:
+            filename = f"inventory_export_{start_date}_{end_date}.xlsx"
+            caption += f"\n📅 التالف للفترة: {start_date} - {end_date}"
+        elif last_seq is not None:
+            filename = f"inventory_changes_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
+            caption = (
+                f"🔄 تم تصدير التغييرات منذ آخر تصدير\n"
+                f"المنتجات: {len(products_df)} - التالف: {len(damaged_df)}"
+            )
+        else:
+            caption += (
+                f"\nℹ️ التالف يشمل آخر {DAMAGED_RETENTION_DAYS} يوماً فقط؛ "
+                f"السجلات المؤرشفة متاحة عبر \"📅 تصدير حسب الفترة\""
+            )
         
         with pd.ExcelWriter(filename, engine='openpyxl') as writer:
             if not products_df.empty:
@@ -638,11 +888,17 @@ async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
         with open(filename, 'rb') as file:
             await update.message.reply_document(
                 document=file,
-                caption="📤 تم تصدير بيانات المخزون بنجاح",
+                caption=caption,
                 reply_markup=ReplyKeyboardMarkup([["🏠 القائمة الرئيسية"]], resize_keyboard=True)
             )
             
         os.remove(filename)
+        
+        # تحديث علامة آخر تصدير للمستخدم (التصدير الكامل أو التغييرات فقط)
+        if not start_date:
+            c.execute("INSERT OR REPLACE INTO export_watermarks (user_id, last_seq, exported_at) VALUES (?, ?, ?)",
+                      (user_id, current_seq, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            conn.commit()
     except Exception as e:
         logger.error(f"Error exporting data: {e}")
         await update.message.reply_text(
@@ -656,6 +912,155 @@ async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await start(update, context)
     return MAIN_MENU
 
+def parse_stock_take_lines(text: str):
+    """تحليل أسطر الجرد وإرجاع الكميات المجمعة لكل باركود والأسطر غير الصالحة"""
+    counts = {}
+    invalid = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        match = STOCK_TAKE_LINE.match(line)
+        if not match:
+            invalid.append(line)
+            continue
+        barcode, quantity = match.group(1), match.group(2)
+        counts[barcode] = counts.get(barcode, 0) + (int(quantity) if quantity else 1)
+    return counts, invalid
+
+def fetch_products_by_barcodes(c, barcodes):
+    """جلب المنتجات لعدة باركودات باستعلام WHERE barcode IN (...) على دفعات"""
+    barcodes = list(barcodes)
+    products = {}
+    for i in range(0, len(barcodes), SQL_IN_CHUNK):
+        chunk = barcodes[i:i+SQL_IN_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        c.execute(f"SELECT barcode, name, quantity FROM products WHERE barcode IN ({placeholders})", chunk)
+        for barcode, name, quantity in c.fetchall():
+            products[barcode] = (name, quantity)
+    return products
+
+def split_message(text: str):
+    """تقسيم النص الطويل إلى رسائل لا تتجاوز حد تيليجرام"""
+    parts = []
+    current = ""
+    for line in text.splitlines(keepends=True):
+        if len(current) + len(line) > MESSAGE_LIMIT and current:
+            parts.append(current)
+            current = ""
+        current += line
+    if current:
+        parts.append(current)
+    return parts
+
+async def handle_stock_take(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """استقبال باركودات الجرد (رسالة متعددة الأسطر أو عدة رسائل مسح)"""
+    text = update.message.text.strip()
+    
+    if text in ["🔙 رجوع", "🏠 القائمة الرئيسية"]:
+        await update.message.reply_text("تم إلغاء الجرد دون تعديل المخزون")
+        return await start(update, context)
+    
+    if text == "✅ إنهاء الجرد":
+        return await finish_stock_take(update, context)
+    
+    counts, invalid = parse_stock_take_lines(text)
+    session = context.user_data.setdefault('stock_take', {})
+    for barcode, quantity in counts.items():
+        session[barcode] = session.get(barcode, 0) + quantity
+    
+    # مسح باركود واحد صحيح لا يحتاج رداً؛ الإجمالي يظهر في التقرير النهائي
+    is_multi_line = len([line for line in text.splitlines() if line.strip()]) > 1
+    if not is_multi_line and not invalid:
+        return STOCK_TAKE
+    
+    reply = (
+        f"📥 تم تسجيل {len(counts)} باركود من هذه الرسالة\n"
+        f"📊 إجمالي الأصناف في الجرد: {len(session)}"
+    )
+    if invalid:
+        reply += "\n\n❌ أسطر غير صالحة (تم تجاهلها):\n" + "\n".join(invalid[:20])
+        if len(invalid) > 20:
+            reply += f"\n... و{len(invalid) - 20} أخرى"
+    
+    await update.message.reply_text(reply, reply_markup=STOCK_TAKE_KEYBOARD)
+    return STOCK_TAKE
+
+async def finish_stock_take(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تطبيق نتائج الجرد في معاملة واحدة وإرسال تقرير الفروقات"""
+    session = context.user_data.get('stock_take', {})
+    
+    if not session:
+        await update.message.reply_text(
+            "📭 لم يتم مسح أي باركود بعد",
+            reply_markup=STOCK_TAKE_KEYBOARD
+        )
+        return STOCK_TAKE
+    
+    conn = None
+    try:
+        conn = sqlite3.connect('inventory.db')
+        c = conn.cursor()
+        # حجز قفل الكتابة قبل القراءة حتى يطابق التقرير الحالة التي تم تعديلها
+        c.execute("BEGIN IMMEDIATE")
+        products = fetch_products_by_barcodes(c, session.keys())
+        
+        changes = []
+        unchanged = 0
+        unknown = []
+        for barcode, counted in session.items():
+            if barcode not in products:
+                unknown.append(barcode)
+                continue
+            name, current = products[barcode]
+            if current == counted:
+                unchanged += 1
+            else:
+                changes.append((barcode, name, current, counted))
+        
+        c.executemany("UPDATE products SET quantity = ? WHERE barcode=?",
+                      [(counted, barcode) for barcode, _, _, counted in changes])
+        
+        report = (
+            f"✅ تم تطبيق الجرد بنجاح!\n\n"
+            f"📊 الأصناف الممسوحة: {len(session)}\n"
+            f"✏️ تم تعديلها: {len(changes)}\n"
+            f"✔️ مطابقة: {unchanged}\n"
+            f"❓ غير مسجلة: {len(unknown)}\n"
+        )
+        if changes:
+            report += "\n📋 الفروقات:\n"
+            for barcode, name, current, counted in changes:
+                diff = (counted or 0) - (current or 0)
+                report += f"🏷️ {barcode} - {name}: {current} ← {counted} ({diff:+d})\n"
+        if unknown:
+            report += "\n❓ باركودات غير مسجلة (لم يتم تعديلها):\n"
+            for barcode in unknown:
+                report += f"🏷️ {barcode} × {session[barcode]}\n"
+        
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Error applying stock take: {e}")
+        if conn:
+            conn.rollback()
+        await update.message.reply_text(
+            "❌ حدث خطأ أثناء تطبيق الجرد! لم يتم تعديل المخزون",
+            reply_markup=ReplyKeyboardMarkup([["🏠 القائمة الرئيسية"]], resize_keyboard=True)
+        )
+        return await start(update, context)
+    finally:
+        if conn:
+            conn.close()
+    
+    # إرسال التقرير بعد اكتمال المعاملة حتى لا يُعرض خطأ الإرسال كفشل في الجرد
+    for part in split_message(report):
+        await update.message.reply_text(
+            part,
+            reply_markup=ReplyKeyboardMarkup([["🏠 القائمة الرئيسية"]], resize_keyboard=True)
+        )
+    
+    return await start(update, context)
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إلغاء العملية الحالية"""
     await update.message.reply_text(
@@ -679,15 +1084,159 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     
     context.user_data.clear()
 
+def list_backups(prefix: str = 'inventory'):
+    """قائمة النسخ الاحتياطية مرتبة من الأحدث إلى الأقدم"""
+    return sorted(glob.glob(os.path.join(BACKUP_DIR, f'{prefix}_*.db.gz')), reverse=True)
+
+def rotate_backups():
+    """حذف النسخ الاحتياطية الأقدم مع الإبقاء على آخر BACKUP_KEEP نسخة وآخر PRE_RESTORE_KEEP نسخة أمان"""
+    for path in list_backups()[BACKUP_KEEP:] + list_backups('pre_restore')[PRE_RESTORE_KEEP:]:
+        os.remove(path)
+        logger.info(f"تم حذف النسخة الاحتياطية القديمة: {path}")
+
+def backup_database(prefix: str = 'inventory'):
+    """أخذ نسخة احتياطية مضغوطة من قاعدة البيانات دون إيقاف عمليات الكتابة"""
+    # منع تداخل نسختين في نفس الثانية (المجدولة و/backup ونسخة الأمان) على نفس الملف المؤقت
+    with BACKUP_LOCK:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        tmp_path = os.path.join(BACKUP_DIR, f"{prefix}_{stamp}.db.tmp")
+        gz_path = os.path.join(BACKUP_DIR, f"{prefix}_{stamp}.db.gz")
+        
+        started = time.monotonic()
+        copied = None
+        src = dst = None
+        try:
+            src = sqlite3.connect('inventory.db')
+            dst = sqlite3.connect(tmp_path)
+            # تثبيت لقطة قراءة (WAL) حتى لا تعيد كتابات المعالجات النسخ من البداية
+            src.execute("BEGIN")
+            src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+            # النسخ على خطوات صغيرة مع مهلة بين الخطوات
+            src.backup(dst, pages=BACKUP_PAGES, progress=lambda status, remaining, total: time.sleep(BACKUP_SLEEP))
+            copied = time.monotonic()
+        finally:
+            if dst:
+                dst.close()
+            if src:
+                src.rollback()
+                src.close()
+            # حذف النسخة غير المضغوطة إذا فشل النسخ حتى لا تتراكم على القرص
+            if copied is None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        
+        # الضغط إلى ملف مؤقت ثم إعادة التسمية حتى لا تظهر نسخة ناقصة في القائمة
+        gz_tmp_path = gz_path + '.tmp'
+        try:
+            with open(tmp_path, 'rb') as f_in, gzip.open(gz_tmp_path, 'wb', compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.replace(gz_tmp_path, gz_path)
+            size = os.path.getsize(tmp_path)
+        finally:
+            os.remove(tmp_path)
+            if os.path.exists(gz_tmp_path):
+                os.remove(gz_tmp_path)
+        finished = time.monotonic()
+        
+        logger.info(
+            f"✅ نسخة احتياطية: {gz_path} - الحجم: {size / 1024 / 1024:.1f}MB "
+            f"→ {os.path.getsize(gz_path) / 1024 / 1024:.1f}MB - "
+            f"النسخ: {copied - started:.2f}s, الضغط: {finished - copied:.2f}s"
+        )
+        rotate_backups()
+        return gz_path
+
+def restore_database(name: str):
+    """استعادة قاعدة البيانات من نسخة احتياطية باستخدام واجهة النسخ في SQLite"""
+    gz_path = os.path.join(BACKUP_DIR, name)
+    tmp_path = gz_path[:-len('.gz')] + '.restore'
+    
+    src = dst = None
+    try:
+        with gzip.open(gz_path, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        
+        # نسخة أمان من الوضع الحالي قبل الاستبدال، خارج النسخ الدورية حتى لا تحذف الدورة أي نسخة
+        backup_database('pre_restore')
+        
+        src = sqlite3.connect(tmp_path)
+        dst = sqlite3.connect('inventory.db')
+        # الاستعادة في خطوة واحدة حتى لا يرى القراء قاعدة بيانات نصف مستعادة
+        src.backup(dst)
+    finally:
+        if dst:
+            dst.close()
+        if src:
+            src.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    # ترقية النسخ القديمة إلى المخطط الحالي (الجداول والأعمدة والـ triggers)
+    init_db()
+    
+    logger.info(f"✅ تمت استعادة قاعدة البيانات من: {gz_path}")
+
+def run_backup_scheduler():
+    """تشغيل النسخ الاحتياطي الدوري في thread منفصل"""
+    while True:
+        time.sleep(BACKUP_INTERVAL)
+        try:
+            backup_database()
+        except Exception as e:
+            logger.error(f"خطأ في النسخ الاحتياطي: {e}")
+
+def is_admin(update: Update):
+    """التحقق من صلاحيات الإدارة"""
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
+
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """أمر /backup لأخذ نسخة احتياطية فورية (للمشرفين فقط)"""
+    if not is_admin(update):
+        await update.message.reply_text("⛔ هذا الأمر متاح للمشرفين فقط")
+        return
+    
+    try:
+        path = await asyncio.to_thread(backup_database)
+        await update.message.reply_text(f"✅ تم أخذ نسخة احتياطية: {os.path.basename(path)}")
+    except Exception as e:
+        logger.error(f"Error running backup: {e}")
+        await update.message.reply_text("❌ حدث خطأ أثناء النسخ الاحتياطي!")
+
+async def restore_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """أمر /restore لعرض النسخ الاحتياطية أو الاستعادة من إحداها (للمشرفين فقط)"""
+    if not is_admin(update):
+        await update.message.reply_text("⛔ هذا الأمر متاح للمشرفين فقط")
+        return
+    
+    backups = [os.path.basename(path) for path in list_backups() + list_backups('pre_restore')]
+    
+    if not context.args:
+        if not backups:
+            await update.message.reply_text("📭 لا توجد نسخ احتياطية")
+            return
+        text = "🗄️ النسخ الاحتياطية المتاحة:\n\n" + "\n".join(backups)
+        text += "\n\nللاستعادة: /restore اسم_النسخة"
+        await update.message.reply_text(text)
+        return
+    
+    name = context.args[0]
+    if name not in backups:
+        await update.message.reply_text("❌ النسخة الاحتياطية غير موجودة!")
+        return
+    
+    try:
+        await asyncio.to_thread(restore_database, name)
+        await update.message.reply_text(f"✅ تمت استعادة قاعدة البيانات من: {name}")
+    except Exception as e:
+        logger.error(f"Error restoring backup: {e}")
+        await update.message.reply_text("❌ حدث خطأ أثناء الاستعادة!")
+
 def run_flask_app():
     """تشغيل تطبيق Flask في منفذ منفصل"""
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 10000)))
 
 def main():
     """الدالة الرئيسية لتشغيل البوت"""
-    if os.path.exists("inventory.db"):
-        os.remove("inventory.db")
-    
     init_db()
     
     # تشغيل Flask في thread منفصل
@@ -695,6 +1244,16 @@ def main():
     flask_thread.daemon = True
     flask_thread.start()
     
+    # تشغيل أرشفة التالف الدورية في thread منفصل
+    archive_thread = threading.Thread(target=run_archive_scheduler)
+    archive_thread.daemon = True
+    archive_thread.start()
+    
+    # تشغيل النسخ الاحتياطي الدوري في thread منفصل
+    backup_thread = threading.Thread(target=run_backup_scheduler)
+    backup_thread.daemon = True
+    backup_thread.start()
+    
     # إنشاء تطبيق التليجرام
     application = Application.builder().token(os.environ.get('TOKEN')).build()
     
@@ -714,12 +1273,16 @@ def main():
             ENTER_DAMAGE_DETAILS: [
                 MessageHandler(filters.Regex("^(\d+|إدخال كمية أخرى|🔙 رجوع|🏠 القائمة الرئيسية)$"), handle_quantity_input),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, save_product_data)
-            ]
+            ],
+            STOCK_TAKE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_stock_take)],
+            ENTER_EXPORT_RANGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_export_range)]
         },
         fallbacks=[CommandHandler('cancel', cancel)]
     )
     
     application.add_handler(conv_handler)
+    application.add_handler(CommandHandler('backup', backup_command))
+    application.add_handler(CommandHandler('restore', restore_command))
     application.add_error_handler(error_handler)
     
     logger.info("✅ البوت يعمل!")